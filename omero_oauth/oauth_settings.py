@@ -77,6 +77,8 @@ OAUTH_SETTINGS_MAPPING = {
         ['OAUTH_ADMIN_USERNAME', '', str_not_empty, None],
     'omero.web.oauth.admin.password':
         ['OAUTH_ADMIN_PASSWORD', '', str_not_empty, None],
+    'omero.web.oauth.admin.poolsize':
+        ['OAUTH_ADMIN_POOL_SIZE', 4, int, None],
 
     'omero.web.oauth.user.timeout':
         ['OAUTH_USER_TIMEOUT', 86400, int, None],
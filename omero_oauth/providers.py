@@ -3,6 +3,7 @@
 
 import logging
 
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 
 import oauth_settings
@@ -17,6 +18,15 @@ logger = logging.getLogger(__name__)
 
 USERAGENT = 'OMERO.oauth'
 
+# Shared adapter so the back-to-back token and userinfo requests in a
+# callback reuse pooled TCP/TLS connections instead of handshaking twice
+_http_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+
+# Resolved user-field templates keyed by provider name. The provider
+# configuration in oauth_settings is loaded once at import and never
+# modified, so templates survive across requests
+_USER_TEMPLATE_CACHE = {}
+
 
 def providers():
     ps = []
@@ -49,6 +59,8 @@ class OauthProvider(object):
                                    scope=self.get('client.scopes'),
                                    redirect_uri=self.get('url.callback'),
                                    **kwargs)
+        self.oauth.mount('https://', _http_adapter)
+        self.oauth.mount('http://', _http_adapter)
 
     def get(self, keypath, default=None, raise_on_missing=False):
         keys = keypath.split('.')
@@ -102,7 +114,15 @@ class OauthProvider(object):
     # user information
 
     def _expand_template(self, name, args):
-        template = self.get('user.{}'.format(name))
+        # Resolve the user-field templates once per provider instead of
+        # walking the configuration dict for each field on every callback
+        templates = _USER_TEMPLATE_CACHE.get(self.name)
+        if templates is None:
+            templates = dict(
+                (field, self.get('user.{}'.format(field)))
+                for field in ('name', 'email', 'firstname', 'lastname'))
+            _USER_TEMPLATE_CACHE[self.name] = templates
+        template = templates[name]
         # Replace None with ''
         args = dict((k, v if v is not None else '') for k, v in args.items())
         return template.format(**args)
@@ -122,8 +142,19 @@ class OauthProvider(object):
         return userinfo
 
     def userinfo_default(self, token, userinfo_url):
+        # If the provider returned an OIDC id_token try to fill the user
+        # fields from its claims and skip the userinfo round-trip
+        if 'id_token' in token:
+            try:
+                decoded = jwt_token_noverify(token['id_token'])
+                return self._expand_all(decoded)
+            except Exception as e:
+                logger.debug(
+                    'Unable to fill userinfo from id_token (%s), '
+                    'falling back to userinfo endpoint', e)
         userinfo = self.oauth.get(userinfo_url).json()
-        logger.debug('Got raw userinfo %s', userinfo)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Got raw userinfo %s', userinfo)
         return self._expand_all(userinfo)
 
     def userinfo_github(self, token, userinfo_url):
@@ -131,9 +162,10 @@ class OauthProvider(object):
         # otherwise we need another API call:
         # https://stackoverflow.com/a/35387123/8062212
         userinfo = self.oauth.get(userinfo_url).json()
-        logger.debug('Got GitHub userinfo %s', userinfo)
         emailinfo = self.oauth.get(userinfo_url + '/emails').json()
-        logger.debug('Got GitHub emails %s', emailinfo)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Got GitHub userinfo %s emails %s',
+                         userinfo, emailinfo)
 
         omename = self._expand_template('name', userinfo)
         ghname = userinfo['name'].split()
@@ -183,7 +215,8 @@ class OauthProvider(object):
             omename, email, firstname, lastname = self._expand_all(decoded)
         except KeyError:
             userinfo = self.oauth.get(userinfo_url).json()
-            logger.debug('Got openid userinfo %s', userinfo)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Got openid userinfo %s', userinfo)
             userinfo.update(decoded)
             omename, email, firstname, lastname = self._expand_all(userinfo)
         return omename, email, firstname, lastname
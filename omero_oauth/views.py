@@ -2,7 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from time import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
@@ -10,6 +17,7 @@ from django.http import (
     HttpResponse,
     HttpResponseRedirect,
 )
+from django.middleware.csrf import get_token
 from django.template import loader as template_loader
 from django.template import RequestContext as Context
 from django.core.exceptions import PermissionDenied
@@ -22,6 +30,7 @@ from omeroweb.webclient.decorators import (
     render_response,
 )
 from omeroweb.connector import Connector
+from omeroweb.custom_context_processor import url_suffix
 from omero_version import (
     build_year,
     omero_version,
@@ -42,10 +51,19 @@ logger = logging.getLogger(__name__)
 
 USERAGENT = 'OMERO.oauth'
 
+# Compiled login-page template, loaded on first use
+_INDEX_TEMPLATE = None
+
+# Run the remote upgrade check at most this often (seconds), instead of
+# once per login
+_UPGRADE_CHECK_INTERVAL = 3600
+_last_upgrade_check = [0.0]
+
 
 class OauthLoginView(WebclientLoginView):
 
     def handle_not_logged_in(self, request):
+        global _INDEX_TEMPLATE
         auth_providers = providers()
         context = {
             'version': omero_version,
@@ -55,10 +73,16 @@ class OauthLoginView(WebclientLoginView):
         }
         if hasattr(settings, 'LOGIN_LOGO'):
             context['LOGIN_LOGO'] = settings.LOGIN_LOGO
-
-        t = template_loader.get_template('oauth/index.html')
-        c = Context(request, context)
-        rsp = t.render(c)
+        # Render with a plain dict instead of a RequestContext: the only
+        # context-processor values the template needs are csrf_token and
+        # url_suffix, so provide just those rather than running every
+        # configured processor
+        context['csrf_token'] = get_token(request)
+        context.update(url_suffix(request))
+
+        if _INDEX_TEMPLATE is None:
+            _INDEX_TEMPLATE = template_loader.get_template('oauth/index.html')
+        rsp = _INDEX_TEMPLATE.render(context)
         return HttpResponse(rsp)
 
     def post(self, request):
@@ -89,10 +113,13 @@ class OauthCallbackView(WebclientLoginView):
 
         oauth = OauthProvider(name, state=state)
         token = oauth.token(code)
-        logger.debug('Got OAuth token %s', token)
-
         userinfo = oauth.get_userinfo(token)
-        logger.debug('Got userinfo %s', userinfo)
+        # One guarded record instead of one per step: stringifying the
+        # token dict (which contains access/refresh tokens) should only
+        # happen when debug logging is really enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('OAuth callback %s token:%s userinfo:%s',
+                         name, token, userinfo)
 
         uid, session = self.get_or_create_account_and_session(userinfo)
         return self.login_with_session(request, session)
@@ -100,8 +127,6 @@ class OauthCallbackView(WebclientLoginView):
     def login_with_session(self, request, session):
         # Based on
         # https://github.com/openmicroscopy/openmicroscopy/blob/v5.4.10/components/tools/OmeroWeb/omeroweb/webgateway/views.py#L2943
-        username = session
-        password = session
         server_id = 1
         is_secure = settings.SECURE
         connector = Connector(server_id, is_secure)
@@ -110,20 +135,26 @@ class OauthCallbackView(WebclientLoginView):
         if settings.CHECK_VERSION:
             compatible = connector.check_version(USERAGENT)
         if compatible:
-            conn = connector.create_connection(
-                USERAGENT, username, password,
-                userip=get_client_ip(request))
+            # Join the sudo session directly instead of re-authenticating
+            # with the uuid as username/password, which would create a
+            # second session on the server
+            connector.omero_session_key = session
+            conn = connector.join_connection(
+                USERAGENT, userip=get_client_ip(request))
             if conn is not None:
                 try:
                     request.session['connector'] = connector
                     # UpgradeCheck URL should be loaded from the server or
                     # loaded omero.web.upgrades.url allows to customize web
                     # only
-                    try:
-                        upgrades_url = settings.UPGRADES_URL
-                    except AttributeError:
-                        upgrades_url = conn.getUpgradesUrl()
-                    upgradeCheck(url=upgrades_url)
+                    if time() - _last_upgrade_check[0] > \
+                            _UPGRADE_CHECK_INTERVAL:
+                        try:
+                            upgrades_url = settings.UPGRADES_URL
+                        except AttributeError:
+                            upgrades_url = conn.getUpgradesUrl()
+                        upgradeCheck(url=upgrades_url)
+                        _last_upgrade_check[0] = time()
                     # super.handle_logged_in does some connection preparation
                     # as wel as redirecting to the main page. We just want
                     # the preparation, so discard the response
@@ -141,37 +172,31 @@ class OauthCallbackView(WebclientLoginView):
 
     def get_or_create_account_and_session(self, userinfo):
         omename, email, firstname, lastname = userinfo
-        adminc = create_admin_conn()
-        try:
-            e = adminc.getObject(
-                'Experimenter', attributes={'omeName': omename})
-            if e:
-                uid = e.id
-            else:
-                gid = self.get_or_create_group(adminc)
+        groupname = self.get_group_name()
+        with _admin_conn() as adminc:
+            uid, gid = _lookup_user_and_group(adminc, omename, groupname)
+            if uid is None:
+                if gid is None:
+                    gid = self.create_group(adminc, groupname)
                 uid = self.create_user(
                     adminc, omename, email, firstname, lastname, gid)
             session = create_session_for_user(adminc, omename)
-        finally:
-            adminc.close()
         return uid, session
 
-    def get_or_create_group(self, adminc, groupname=None):
-        if not groupname:
-            groupname = oauth_settings.OAUTH_GROUP_NAME
-            if oauth_settings.OAUTH_GROUP_NAME_TEMPLATETIME:
-                groupname = datetime.now().strftime(groupname)
-        g = adminc.getObject(
-            'ExperimenterGroup', attributes={'name': groupname})
-        if g:
-            gid = g.id
-        else:
-            logger.info('Creating new oauth group: %s %s', groupname,
-                        oauth_settings.OAUTH_GROUP_PERMS)
-            # Parent methods BlitzGateway.createGroup is easier to use than
-            # the child method
-            gid = super(OmeroWebGateway, adminc).createGroup(
-                name=groupname, perms=oauth_settings.OAUTH_GROUP_PERMS)
+    def get_group_name(self):
+        groupname = oauth_settings.OAUTH_GROUP_NAME
+        if oauth_settings.OAUTH_GROUP_NAME_TEMPLATETIME:
+            groupname = datetime.now().strftime(groupname)
+        return groupname
+
+    def create_group(self, adminc, groupname):
+        logger.info('Creating new oauth group: %s %s', groupname,
+                    oauth_settings.OAUTH_GROUP_PERMS)
+        # Parent methods BlitzGateway.createGroup is easier to use than
+        # the child method
+        gid = super(OmeroWebGateway, adminc).createGroup(
+            name=groupname, perms=oauth_settings.OAUTH_GROUP_PERMS)
+        _cache_group_id(groupname, gid)
         return gid
 
     def create_user(
@@ -185,25 +210,140 @@ class OauthCallbackView(WebclientLoginView):
         return uid
 
 
-def create_admin_conn():
-    adminc = OmeroWebGateway(
+# Cache of resolved groupname -> group-id. Groups are never deleted by
+# this app so entries stay valid; templated (time-based) groupnames get
+# their own keys as the rendered name changes
+_GROUP_ID_CACHE = {}
+_group_id_lock = threading.Lock()
+
+
+def _cached_group_id(groupname):
+    with _group_id_lock:
+        return _GROUP_ID_CACHE.get(groupname)
+
+
+def _cache_group_id(groupname, gid):
+    if gid is not None:
+        with _group_id_lock:
+            _GROUP_ID_CACHE[groupname] = gid
+
+
+def _lookup_user_and_group(adminc, omename, groupname):
+    """
+    Fetch the experimenter and group ids together with lightweight
+    projection queries instead of fully loading both objects.
+    :return tuple: (experimenter-id or None, group-id or None)
+    """
+    qs = adminc.getQueryService()
+    params = omero.sys.ParametersI()
+    params.addString('omename', omename)
+    params.addString('groupname', groupname)
+    rows = unwrap(qs.projection(
+        'SELECT e.id, (SELECT g.id FROM ExperimenterGroup g '
+        'WHERE g.name = :groupname) '
+        'FROM Experimenter e WHERE e.omeName = :omename', params))
+    if rows:
+        _cache_group_id(groupname, rows[0][1])
+        return rows[0][0], rows[0][1]
+    # New user: the anchored query returned nothing so look up the
+    # group on its own, unless it has been resolved before
+    gid = _cached_group_id(groupname)
+    if gid is not None:
+        return None, gid
+    params = omero.sys.ParametersI()
+    params.addString('groupname', groupname)
+    rows = unwrap(qs.projection(
+        'SELECT g.id FROM ExperimenterGroup g WHERE g.name = :groupname',
+        params))
+    if rows:
+        _cache_group_id(groupname, rows[0][0])
+        return None, rows[0][0]
+    return None, None
+
+
+# Pool of long-lived admin connections shared across requests, so that
+# each OAuth callback doesn't pay for a full connection handshake
+_admin_pool = queue.Queue()
+
+
+@contextmanager
+def _admin_conn():
+    """
+    Context manager yielding a live admin connection from the pool,
+    creating a new one if the pool is empty or the connection has died.
+    The connection is returned to the pool on exit.
+    """
+    try:
+        adminc = _admin_pool.get_nowait()
+    except queue.Empty:
+        adminc = None
+    if adminc is not None:
+        try:
+            adminc.c.sf.keepAlive(None)
+        except Exception:
+            logger.info('Pooled admin connection dead, reconnecting')
+            try:
+                adminc.close()
+            except Exception:
+                pass
+            adminc = None
+    if adminc is None:
+        adminc = create_admin_conn()
+    try:
+        yield adminc
+    finally:
+        _release_admin_conn(adminc)
+
+
+def _release_admin_conn(adminc):
+    if _admin_pool.qsize() < oauth_settings.OAUTH_ADMIN_POOL_SIZE:
+        _admin_pool.put(adminc)
+    else:
+        adminc.close()
+
+
+def _make_admin_gateway():
+    return OmeroWebGateway(
         host=oauth_settings.OAUTH_HOST,
         port=oauth_settings.OAUTH_PORT,
         username=oauth_settings.OAUTH_ADMIN_USERNAME,
         passwd=oauth_settings.OAUTH_ADMIN_PASSWORD,
         secure=True)
+
+
+def create_admin_conn():
+    adminc = _make_admin_gateway()
     if not adminc.connect():
         raise Exception('Unable to obtain admin connection')
+    # The service handle is stable for the lifetime of the connection,
+    # fetch it once instead of per created session
+    adminc._oauth_session_service = adminc.c.getSession().getSessionService()
     return adminc
 
 
+# Principal is invariant apart from the name, keep one instance per
+# thread instead of constructing one per login
+_principal_local = threading.local()
+
+
+def _user_principal(omename):
+    p = getattr(_principal_local, 'principal', None)
+    if p is None:
+        p = omero.sys.Principal()
+        # p.group = 'user'
+        p.eventType = 'User'
+        _principal_local.principal = p
+    p.name = omename
+    return p
+
+
 def create_session_for_user(adminc, omename):
     # https://github.com/openmicroscopy/openmicroscopy/blob/v5.4.10/examples/OmeroClients/sudo.py
-    ss = adminc.c.getSession().getSessionService()
-    p = omero.sys.Principal()
-    p.name = omename
-    # p.group = 'user'
-    p.eventType = 'User'
+    ss = getattr(adminc, '_oauth_session_service', None)
+    if ss is None:
+        ss = adminc.c.getSession().getSessionService()
+        adminc._oauth_session_service = ss
+    p = _user_principal(omename)
     # http://downloads.openmicroscopy.org/omero/5.4.10/api/slice2html/omero/api/ISession.html#createSessionWithTimeout
     # This is the absolute timeout (relative to creation time)
     user_session = unwrap(ss.createSessionWithTimeout(
@@ -245,12 +385,9 @@ def sessiontoken(request, **kwargs):
         'sessiontoken_enabled': oauth_settings.OAUTH_SESSIONTOKEN_ENABLE,
     }
     if oauth_settings.OAUTH_SESSIONTOKEN_ENABLE:
-        adminc = create_admin_conn()
-        try:
+        with _admin_conn() as adminc:
             new_session = create_session_for_user(
                 adminc, conn.getUser().omeName)
-        finally:
-            adminc.close()
         context['new_session'] = new_session
     t = template_loader.get_template('oauth/sessiontoken.html')
     c = Context(request, context)